@@ -1,195 +1,369 @@
+import functools
+import itertools
 import json
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Optional fast JSON parser, in measured order: orjson, then pysimdjson, then
+# ujson (pip install orjson / pysimdjson / ujson). stdlib json is the fallback
+# when none is installed or the fast parser rejects a payload.
+try:
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:
+    try:
+        import simdjson
+        # One parser reused across frames so its buffers are only allocated
+        # once; recursive=True returns plain dicts/lists
+        _json_loads = functools.partial(simdjson.Parser().parse, recursive=True)
+    except ImportError:
+        try:
+            import ujson
+            _json_loads = ujson.loads
+        except ImportError:
+            _json_loads = json.loads
+
+# Strip one pair of enclosing double quotes from OSC payloads. Set to False
+# if your OSC In DAT never quotes string arguments.
+STRIP_QUOTES = True
+
 # Global state to persist values across frames (prevents flickering)
-# Structure: { 'device_id': { 'channel_name': value } }
+# Structure: { 'device_id': { 'device_id_channel_name': value } }
+# Inner keys are full CHOP channel names; grouping by device keeps the
+# CHOP channel order device by device.
 DEVICE_STATE = {}
 
-def cook(scriptOp):
+# Raw OSC device IDs -> cleaned IDs (device IDs are a small, stable set)
+_CLEAN_ID_CACHE = {}
+
+# (prefix, key) -> 'prefix_key' for channel names, built once per pair
+_NAME_CACHE = {}
+
+# CHOP channel handles by full channel name, kept between cooks
+_CHAN_HANDLES = {}
+_CHOP_READY = False
+
+# Last raw payload applied per device; re-applying it would not change state
+_LAST_RAW = {}
+
+# (device_id, data_str) rows read from the OSC In DAT on the previous cook
+_PREV_ROWS = []
+
+# Cached OSC In DAT reference (re-discovered if it goes missing or invalid)
+_OSC_OP = None
+
+def cook(scriptOp, _state=DEVICE_STATE, _clean_ids=_CLEAN_ID_CACHE, _handles=_CHAN_HANDLES,
+         _last_raw=_LAST_RAW, _prev_rows=_PREV_ROWS):
     """
     Main function called every frame by TouchDesigner
+    (module dicts are bound as defaults so the row loop uses fast locals)
     """
     
-    # Get the OSC In DAT
-    osc = None
-    try:
-        osc = op('oscin1')
-    except:
-        pass
-    
-    if osc is None:
+    # Get the OSC In DAT (looked up once, then reused while it stays valid)
+    global _OSC_OP, _CHOP_READY
+    osc = _OSC_OP
+    if osc is None or not osc.valid:
+        # op() returns None for a missing operator, so one try covers both names
         try:
-            osc = op('oscin')
+            osc = op('oscin1') or op('oscin')
         except:
-            pass
+            osc = None
+        _OSC_OP = osc
             
     # If still not found, don't process new messages, but still output current state
     # The script should fall through to the output section instead of returning.
     
     # Process new messages
-    if osc is not None and osc.numRows > 1:
-        for i in range(1, osc.numRows):
-            row = osc.row(i)
-            if len(row) < 4: continue
-            
-            device_id = row[2].val
-            data_str = row[3].val
-            
-            # Clean ID
-            clean_id = device_id.replace('"', '').replace(' ', '_')
-            if clean_id not in DEVICE_STATE:
-                DEVICE_STATE[clean_id] = {}
+    changed = False
+    if osc is not None and osc.numRows > 1 and osc.numCols >= 4:
+        # Fetch the device-ID and payload columns in two calls (row 0 is the
+        # header); fall back to reading the two cells per row
+        col = getattr(osc, 'col', None)
+        if col is not None:
+            rows = [(d.val, p.val) for d, p in zip(col(2), col(3))]
+            del rows[0]
+        else:
+            rows = [(osc[i, 2].val, osc[i, 3].val) for i in range(1, osc.numRows)]
+        
+        # Replay every row oldest-first so the newest payload for each
+        # channel wins. Rows carry no sequence number, so there is no safe
+        # way to tell which ones were already applied. If the DAT reads the
+        # same as last cook, replaying it cannot change the state; otherwise
+        # the per-device last-payload check keeps repeats from being re-parsed.
+        if rows == _prev_rows:
+            rows = ()
+        else:
+            _prev_rows[:] = rows
+        for device_id, data_str in rows:
+            # Clean ID (cached per raw ID)
+            clean_id = _clean_ids.get(device_id)
+            if clean_id is None:
+                clean_id = device_id.replace('"', '').replace(' ', '_')
+                _clean_ids[device_id] = clean_id
+            dev_state = _state.get(clean_id)
+            if dev_state is None:
+                dev_state = _state[clean_id] = {}
+                
+            # Skip payloads identical to the last one applied for this device
+            if _last_raw.get(clean_id) == data_str:
+                continue
+            _last_raw[clean_id] = data_str
                 
             # Clean payload
-            if data_str.startswith('"') and data_str.endswith('"'):
+            if STRIP_QUOTES and len(data_str) >= 2 and data_str[0] == '"' and data_str[-1] == '"':
                 data_str = data_str[1:-1]
                 
+            changed = True
             try:
-                data = json.loads(data_str)
-                
-                if isinstance(data, dict):
-                    # --- MUSE S BATCH HANDLING ---
-                    # 1. Flatten Batch into list of packets
-                    packets = []
-                    if 'samples' in data:
-                        # Add all samples from batch
-                        packets.extend(data['samples'])
-                    else:
-                        # Add single packet
-                        packets.append(data)
-                        
-                    # 2. Process all packets in this update
-                    for packet in packets:
-                        p_type = packet.get('type')
-                        p_data = packet.get('data', {})
-                        
-                        # EEG
-                        if p_type == 'eeg':
-                            for k, v in p_data.items():
-                                DEVICE_STATE[clean_id][f'eeg_{k}'] = v
-                                
-                        # PPG
-                        elif p_type == 'ppg':
-                            for k, v in p_data.items():
-                                DEVICE_STATE[clean_id][f'ppg_{k}'] = v
-                                
-                        # IMU (Combined Accel/Gyro)
-                        elif p_type == 'imu':
-                            if 'accel' in p_data:
-                                for k, v in p_data['accel'].items():
-                                    DEVICE_STATE[clean_id][f'accel_{k}'] = v
-                            if 'gyro' in p_data:
-                                for k, v in p_data['gyro'].items():
-                                    DEVICE_STATE[clean_id][f'gyro_{k}'] = v
-                                    
-                        # Legacy/Generic Accel
-                        elif p_type in ['accel', 'accelerometer']:
-                             for k, v in p_data.items():
-                                DEVICE_STATE[clean_id][f'accel_{k}'] = v
-                                
-                        # Legacy/Generic Gyro
-                        elif p_type == 'gyro':
-                             for k, v in p_data.items():
-                                DEVICE_STATE[clean_id][f'gyro_{k}'] = v
-                                
-                        # Heart Rate
-                        elif p_type == 'heart_rate':
-                            DEVICE_STATE[clean_id]['bpm'] = packet.get('bpm', 0)
-                            
-                        # iPhone Sensor Bridge
-                        elif p_type == 'phone_sensors':
-                            # Accelerometer
-                            if 'accel_x' in packet:
-                                DEVICE_STATE[clean_id]['accel_x'] = packet.get('accel_x', 0)
-                                DEVICE_STATE[clean_id]['accel_y'] = packet.get('accel_y', 0)
-                                DEVICE_STATE[clean_id]['accel_z'] = packet.get('accel_z', 0)
-                                
-                            # Gyroscope
-                            if 'gyro_x' in packet:
-                                DEVICE_STATE[clean_id]['gyro_x'] = packet.get('gyro_x', 0)
-                                DEVICE_STATE[clean_id]['gyro_y'] = packet.get('gyro_y', 0)
-                                DEVICE_STATE[clean_id]['gyro_z'] = packet.get('gyro_z', 0)
-                                
-                            # Magnetometer
-                            if 'mag_x' in packet:
-                                DEVICE_STATE[clean_id]['mag_x'] = packet.get('mag_x', 0)
-                                DEVICE_STATE[clean_id]['mag_y'] = packet.get('mag_y', 0)
-                                DEVICE_STATE[clean_id]['mag_z'] = packet.get('mag_z', 0)
-                                
-                            # Orientation
-                            if 'pitch' in packet:
-                                DEVICE_STATE[clean_id]['pitch'] = packet.get('pitch', 0)
-                                DEVICE_STATE[clean_id]['roll'] = packet.get('roll', 0)
-                                DEVICE_STATE[clean_id]['yaw'] = packet.get('yaw', 0)
-                                
-                            # Quaternion
-                            if 'quat_x' in packet:
-                                DEVICE_STATE[clean_id]['quat_x'] = packet.get('quat_x', 0)
-                                DEVICE_STATE[clean_id]['quat_y'] = packet.get('quat_y', 0)
-                                DEVICE_STATE[clean_id]['quat_z'] = packet.get('quat_z', 0)
-                                DEVICE_STATE[clean_id]['quat_w'] = packet.get('quat_w', 0)
-                                
-                            # Environment
-                            if 'pressure' in packet:
-                                DEVICE_STATE[clean_id]['pressure'] = packet.get('pressure', 0)
-                            if 'altitude' in packet:
-                                DEVICE_STATE[clean_id]['altitude'] = packet.get('altitude', 0)
-                                
-                            # Location
-                            if 'latitude' in packet:
-                                DEVICE_STATE[clean_id]['latitude'] = packet.get('latitude', 0)
-                                DEVICE_STATE[clean_id]['longitude'] = packet.get('longitude', 0)
-                                DEVICE_STATE[clean_id]['speed'] = packet.get('speed', 0)
-                                DEVICE_STATE[clean_id]['heading'] = packet.get('heading', 0)
-                                
-                            # Audio
-                            if 'audio_level' in packet:
-                                DEVICE_STATE[clean_id]['audio_level'] = packet.get('audio_level', 0)
-                                
-                            # Advanced Motion
-                            if 'gravity_x' in packet:
-                                DEVICE_STATE[clean_id]['gravity_x'] = packet.get('gravity_x', 0)
-                                DEVICE_STATE[clean_id]['gravity_y'] = packet.get('gravity_y', 0)
-                                DEVICE_STATE[clean_id]['gravity_z'] = packet.get('gravity_z', 0)
-                                
-                            if 'user_accel_x' in packet:
-                                DEVICE_STATE[clean_id]['user_accel_x'] = packet.get('user_accel_x', 0)
-                                DEVICE_STATE[clean_id]['user_accel_y'] = packet.get('user_accel_y', 0)
-                                DEVICE_STATE[clean_id]['user_accel_z'] = packet.get('user_accel_z', 0)
-                            
-                # Numeric Fallback
-                elif isinstance(data, (int, float)):
-                    DEVICE_STATE[clean_id]['value'] = data
-                    
+                process_payload(dev_state, clean_id, data_str)
             except:
                 pass
 
     # --- OUTPUT TO CHOP ---
+    # Channels persist between cooks. Set the CHOP up once, and rebuild it
+    # only when its channels no longer match our handles (script reload,
+    # external reset). Handle names only ever grow, so the count is enough.
+    if not _CHOP_READY or scriptOp.numChans != len(_handles):
+        scriptOp.clear()
+        scriptOp.numSamples = 1
+        _handles.clear()
+        _CHOP_READY = True
+        changed = True
+    
+    # Nothing new this cook: the channels still hold last cook's values
+    if not changed:
+        return
+    
+    # Add channels seen for the first time. CHOP channels run device by
+    # device in DEVICE_STATE order. New channels usually belong to the last
+    # device and are appended; if an earlier device gained one, the CHOP is
+    # rebuilt so channel indices keep the same grouping.
+    num_chans = sum(map(len, _state.values()))
+    if num_chans != len(_handles):
+        names = [full_name for channels in _state.values() for full_name in channels]
+        if names[:len(_handles)] != list(_handles):
+            scriptOp.clear()
+            scriptOp.numSamples = 1
+            _handles.clear()
+        append_chan = scriptOp.appendChan
+        for full_name in names[len(_handles):]:
+            _handles[full_name] = append_chan(full_name)
+    
     # Always write the FULL state to keep channels alive
-    scriptOp.clear()
-    scriptOp.numSamples = 1
+    if numpy is not None and hasattr(scriptOp, 'copyNumpyArray'):
+        # One bulk copy instead of a Python -> CHOP call per channel
+        values = numpy.fromiter(
+            itertools.chain.from_iterable(channels.values() for channels in _state.values()),
+            dtype=numpy.float32, count=num_chans)
+        scriptOp.copyNumpyArray(values.reshape(-1, 1))
+    else:
+        for channels in _state.values():
+            for full_name, val in channels.items():
+                _handles[full_name][0] = val
+
+
+# --- PACKET HANDLERS ---
+# Each handler takes (state, dev_id, p_data, packet) and writes values into
+# the device's state under full channel names (e.g. device_3_eeg_tp9).
+# Dispatched by packet 'type' through _DISPATCH.
+
+# (dev_id, group) -> { key: 'dev_id_group_key' }, so each channel name is
+# built once per device instead of on every packet
+_GROUP_NAMES = {}
+
+
+def _write_group(state, dev_id, group, values):
+    names = _GROUP_NAMES.get((dev_id, group))
+    if names is None:
+        names = _GROUP_NAMES[(dev_id, group)] = {}
+    get_name = names.get
+    for k, v in values.items():
+        t = type(v)
+        if t is list and v:
+            # Multi-sample block (e.g. EEG/PPG): the CHOP holds one sample
+            # per channel, so keep the newest
+            v = v[len(v) - 1]
+            t = type(v)
+        # Exact type check: skips strings/None/nested values and bools
+        if t is not float and t is not int:
+            continue
+        name = get_name(k)
+        if name is None:
+            name = names[k] = join_name(join_name(dev_id, group), k)
+        state[name] = v
+
+
+def _handle_eeg(state, dev_id, p_data, packet):
+    _write_group(state, dev_id, 'eeg', p_data)
+
+
+def _handle_ppg(state, dev_id, p_data, packet):
+    _write_group(state, dev_id, 'ppg', p_data)
+
+
+def _handle_imu(state, dev_id, p_data, packet):
+    # IMU (Combined Accel/Gyro)
+    if 'accel' in p_data:
+        _write_group(state, dev_id, 'accel', p_data['accel'])
+    if 'gyro' in p_data:
+        _write_group(state, dev_id, 'gyro', p_data['gyro'])
+
+
+def _handle_accel(state, dev_id, p_data, packet):
+    # Legacy/Generic Accel
+    _write_group(state, dev_id, 'accel', p_data)
+
+
+def _handle_gyro(state, dev_id, p_data, packet):
+    # Legacy/Generic Gyro
+    _write_group(state, dev_id, 'gyro', p_data)
+
+
+def _handle_heart_rate(state, dev_id, p_data, packet):
+    bpm = packet.get('bpm', 0)
+    t = type(bpm)
+    if t is float or t is int:
+        state[join_name(dev_id, 'bpm')] = bpm
+
+
+# iPhone Sensor Bridge fields, grouped by sensor. Channel suffixes equal the
+# JSON keys; keys not listed here are ignored.
+PHONE_SENSOR_GROUPS = (
+    ('accel_x', 'accel_y', 'accel_z'),                  # Accelerometer
+    ('gyro_x', 'gyro_y', 'gyro_z'),                     # Gyroscope
+    ('mag_x', 'mag_y', 'mag_z'),                        # Magnetometer
+    ('pitch', 'roll', 'yaw'),                           # Orientation
+    ('quat_x', 'quat_y', 'quat_z', 'quat_w'),           # Quaternion
+    ('pressure', 'altitude'),                           # Environment
+    ('latitude', 'longitude', 'speed', 'heading'),      # Location
+    ('audio_level',),                                   # Audio
+    ('gravity_x', 'gravity_y', 'gravity_z'),            # Advanced Motion
+    ('user_accel_x', 'user_accel_y', 'user_accel_z'),
+)
+
+# dev_id -> { json key: full channel name } for every allowed phone key
+_PHONE_NAMES = {}
+
+
+def _handle_phone_sensors(state, dev_id, p_data, packet):
+    # iPhone Sensor Bridge (fields live on the packet itself)
+    names = _PHONE_NAMES.get(dev_id)
+    if names is None:
+        names = _PHONE_NAMES[dev_id] = {
+            key: join_name(dev_id, key)
+            for keys in PHONE_SENSOR_GROUPS for key in keys
+        }
     
-    for dev_id, channels in DEVICE_STATE.items():
-        for ch_name, val in channels.items():
-            # Create channel name: device_1_eeg_tp9
-            full_name = f"{dev_id}_{ch_name}"
-            chan = scriptOp.appendChan(full_name)
-            chan[0] = val
+    # Walk only the keys that were sent; the name lookup doubles as the
+    # allowlist check, so partial payloads cost proportionally less
+    get_name = names.get
+    for k, v in packet.items():
+        name = get_name(k)
+        if name is not None:
+            t = type(v)
+            if t is float or t is int:
+                state[name] = v
+
+
+_DISPATCH = {
+    'eeg': _handle_eeg,
+    'ppg': _handle_ppg,
+    'imu': _handle_imu,
+    'accel': _handle_accel,
+    'accelerometer': _handle_accel,
+    'gyro': _handle_gyro,
+    'heart_rate': _handle_heart_rate,
+    'phone_sensors': _handle_phone_sensors,
+}
+
+
+# First characters of payloads that float() may accept
+_NUMERIC_LEAD = frozenset('-+.0123456789')
+
+
+def process_payload(state, dev_id, data_str, _dispatch=_DISPATCH):
+    """
+    Parse one OSC payload and write its values into dev_id's state
+    """
+    # Route on the first character so only JSON objects reach the parser.
+    # Anything else (arrays, strings, plain text) never produced channels.
+    c = data_str[:1]
+    if c.isspace():
+        # json.loads() and float() both accept surrounding whitespace
+        data_str = data_str.strip()
+        c = data_str[:1]
+    if c == '{':
+        data = parse_payload(data_str)
+        
+        # --- MUSE S BATCH HANDLING ---
+        # 1. Iterate the batch in place, or wrap a single packet in a tuple
+        packets = data.get('samples')
+        if packets is None:
+            packets = (data,)
+            
+        # 2. Process all packets in this update
+        for packet in packets:
+            get = packet.get
+            handler = _dispatch.get(get('type'))
+            if handler is not None:
+                handler(state, dev_id, get('data', {}), packet)
+                
+    # Plain numbers (simple sensors) skip the JSON parser entirely
+    elif c in _NUMERIC_LEAD:
+        try:
+            state[join_name(dev_id, 'value')] = float(data_str)
+        except ValueError:
+            pass
+
+
+def join_name(prefix, key):
+    """
+    Return 'prefix_key', reusing the string built on earlier frames
+    """
+    name = _NAME_CACHE.get((prefix, key))
+    if name is None:
+        name = _NAME_CACHE[(prefix, key)] = prefix + '_' + key
+    return name
+
+
+def parse_payload(data_str):
+    """
+    Parse a JSON payload with the fastest installed parser, then stdlib json
+    """
+    if _json_loads is not json.loads:
+        try:
+            return _json_loads(data_str)
+        except ValueError:
+            pass
+    return json.loads(data_str)
 
 
-def flatten_json(data, scriptOp, prefix=''):
+def flatten_json(data, appendChan, prefix=''):
     """
-    Recursively flatten JSON into CHOP channels
+    Flatten nested JSON into CHOP channels via appendChan (scriptOp.appendChan)
+    (walks an explicit stack instead of recursing; names come from join_name)
     """
-    if isinstance(data, dict):
-        for key, value in data.items():
-            new_key = f'{prefix}_{key}' if prefix else key
-            if isinstance(value, (int, float)):
-                chan = scriptOp.appendChan(new_key)
+    stack = [(data, prefix)]
+    while stack:
+        node, path = stack.pop()
+        if type(node) is not dict:
+            continue
+        for key, value in node.items():
+            new_key = join_name(path, key) if path else key
+            t = type(value)
+            if t is int or t is float:
+                chan = appendChan(new_key)
                 chan[0] = value
-            elif isinstance(value, dict):
-                flatten_json(value, scriptOp, new_key)
-            elif isinstance(value, list):
+            elif t is dict:
+                stack.append((value, new_key))
+            elif t is list:
+                # Build the prefix once; only the index changes per item
+                base = new_key + '_'
                 for i, item in enumerate(value):
-                    if isinstance(item, (int, float)):
-                        chan = scriptOp.appendChan(f'{new_key}_{i}')
+                    t = type(item)
+                    if t is int or t is float:
+                        chan = appendChan(base + str(i))
                         chan[0] = item